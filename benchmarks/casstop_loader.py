@@ -0,0 +1,25 @@
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+casstop is installed as a script without a .py extension, so it can't just
+be imported.  This loads it as a module so the benchmarks can get at its
+classes.
+"""
+
+import imp
+import os
+import sys
+
+CASSTOP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'casstop')
+
+
+def load_casstop(path=CASSTOP):
+    """Load casstop as a module named "casstop".
+    :param path: location of the casstop script
+    :returns: the module
+    """
+    if 'casstop' in sys.modules:
+        return sys.modules['casstop']
+    # Otherwise imp leaves a "casstopc" file lying around next to the script.
+    sys.dont_write_bytecode = True
+    return imp.load_source('casstop', path)
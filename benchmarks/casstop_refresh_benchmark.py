@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+Time casstop's refresh cycle against fake_mx4j.py as the cluster grows.
+
+For each cluster size a fake cluster is started, and a fresh process loads
+casstop, discovers the cluster from its first node and runs --refreshes
+refreshes.  It reports how long discovery took, and the median wall clock
+and CPU time per refresh for casstop itself (the fake cluster runs in its
+own process).  It also reports requests still outstanding at the refresh
+deadline, and casstop's resident memory at the end:
+
+    casstop_refresh_benchmark.py --engine async --nodes 100 --nodes 1000
+
+Options after "--" are passed to fake_mx4j.py (e.g. "-- --slow 0.01").
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import casstop_loader
+import fake_mx4j
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def resident_mb():
+    """Current resident set size, in MB."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # Not Linux: the peak will have to do.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def cpu_seconds():
+    """User and system CPU time used by this process so far."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(options):
+    """Run in the child process: load casstop, point it at the fake cluster
+    and time some refreshes.
+    :returns: dict of results
+    """
+    casstop = casstop_loader.load_casstop()
+    casstop_options, _ = casstop.parser.parse_args(['--port', str(options.port),
+                                                    '--engine', options.engine,
+                                                    '--fetch-mode', options.fetch_mode,
+                                                    '--workers', str(options.workers),
+                                                    '--read-timeout', str(options.read_timeout)])
+    casstop.CursedIntDataAttribute.mx4j_port = casstop_options.port
+    casstop.CursedCluster.fetch_mode = casstop_options.fetch_mode
+    casstop.mx4j_pool.per_host = casstop_options.max_connections
+    casstop.mx4j_pool.connect_timeout = casstop_options.connect_timeout
+    casstop.mx4j_pool.read_timeout = casstop_options.read_timeout
+    # The nodes go by their addresses: names from reverse DNS (or a hosts
+    # file) would have to resolve again to be fetched from.
+    with tempfile.NamedTemporaryFile() as hosts_file:
+        for index in range(options.child):
+            hosts_file.write('%s %s\n' % (fake_mx4j.node_address(index), fake_mx4j.node_address(index)))
+        hosts_file.flush()
+        casstop.resolver.load(hosts_file.name)
+
+    start, cpu = time.time(), cpu_seconds()
+    cluster = casstop.CursedCluster(fake_mx4j.node_address(0))
+    discovery = time.time() - start
+    poller, collector = casstop.collection_engine(casstop_options)
+    monitor = casstop.ClusterMonitor(cluster, poller, collector)
+    monitor.refresh_delay = options.deadline
+    walls, cpus, lates = [], [], []
+    for _ in range(options.refreshes):
+        start, cpu = time.time(), cpu_seconds()
+        lates.append(monitor.update(start))
+        walls.append(time.time() - start)
+        cpus.append(cpu_seconds() - cpu)
+    return {'hosts': len(cluster[casstop.HOSTNAMES]), 'discovery': discovery,
+            'wall': sorted(walls)[len(walls) / 2], 'cpu': sorted(cpus)[len(cpus) / 2],
+            'late': max(lates), 'rss': resident_mb()}
+
+
+def wait_for(fake, address, port, timeout=30.0):
+    """Wait for the fake cluster to start listening."""
+    deadline = time.time() + timeout
+    while time.time() < deadline and fake.poll() is None:
+        try:
+            socket.create_connection((address, port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise SystemExit('fake_mx4j.py did not start listening on port %d' % port)
+
+
+def run_size(nodes, options):
+    """Start a fake cluster of the given size, and measure casstop on it
+    in a fresh process.
+    :returns: dict of results
+    """
+    fake = subprocess.Popen([sys.executable, os.path.join(HERE, 'fake_mx4j.py'),
+                             '--nodes', str(nodes), '--port', str(options.port)] + options.fake_args,
+                            stdout=open(os.devnull, 'w'))
+    try:
+        wait_for(fake, fake_mx4j.node_address(0), options.port)
+        child = [sys.executable, os.path.abspath(__file__), '--child', str(nodes),
+                 '--port', str(options.port), '--engine', options.engine, '--fetch-mode', options.fetch_mode,
+                 '--workers', str(options.workers), '--refreshes', str(options.refreshes),
+                 '--deadline', str(options.deadline), '--read-timeout', str(options.read_timeout)]
+        return json.loads(subprocess.check_output(child).splitlines()[-1])
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def cli_parsing():
+    """Parse the command line.
+    :returns: option set
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, action="append",
+                        help="Cluster size; may be repeated (default: 10, 100, 500, 1000 and 2000)")
+    parser.add_argument("-r", "--refreshes", type=int, default=5,
+                        help="Timed refreshes per cluster size (default: %(default)d)")
+    parser.add_argument("-e", "--engine", choices=['threads', 'async'], default='threads',
+                        help="casstop collection engine (default: %(default)s)")
+    parser.add_argument("--fetch-mode", choices=['mbean', 'attribute'], default='mbean',
+                        help="casstop fetch mode (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=32,
+                        help="casstop worker threads (default: %(default)d)")
+    parser.add_argument("--deadline", type=float, default=30.0,
+                        help="Seconds a refresh may take (default: %(default)g)")
+    parser.add_argument("--read-timeout", type=float, default=10.0,
+                        help="casstop read timeout (default: %(default)g)")
+    parser.add_argument("-p", "--port", type=int, default=18081,
+                        help="Port for the fake cluster (default: %(default)d)")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("fake_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    options.fake_args = [arg for arg in options.fake_args if arg != '--']
+    return options
+
+
+def main():
+    """Main entry point."""
+    options = cli_parsing()
+    # Every node gets its own keep-alive connections.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if options.child:
+        print json.dumps(measure(options))
+        sys.stdout.flush()
+        # casstop's worker threads are still waiting for work, and would
+        # only spray tracebacks as the interpreter tears down around them.
+        os._exit(0)
+    print '%6s %6s %10s %10s %10s %6s %8s' % ('nodes', 'hosts', 'discover s', 'refresh s', 'cpu s', 'late', 'rss MB')
+    for nodes in options.nodes or [10, 100, 500, 1000, 2000]:
+        result = run_size(nodes, options)
+        print '%6d %6d %10.3f %10.3f %10.3f %6d %8.1f' % (nodes, result['hosts'], result['discovery'],
+                                                         result['wall'], result['cpu'], result['late'],
+                                                         result['rss'])
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+An in-memory stand-in for the Cassandra keyspace the repair scheduler
+uses, so that its MUTEX and claim flow can be exercised without a cluster.
+
+FakeConnection has the same interface as the scheduler's NativeConnection
+and ThriftConnection, and is registered as the "fake" driver.  Every
+connection shares the FakeKeyspace in FakeConnection.keyspace_data, which
+answers each of CqlWrapper's statements (and nothing else).  Queries and
+connections can be made to take time, and reads at consistency ONE can
+lag behind other nodes' writes, the way they can in a real cluster.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cassandra_repair_scheduler
+
+CqlWrapper = cassandra_repair_scheduler.CqlWrapper
+
+
+class FakeNode(object):
+
+    """Where one node sits in the fake cluster."""
+
+    def __init__(self, nodename, data_center, token, rack='rack1'):
+        self.nodename = nodename
+        self.data_center = data_center
+        self.token = token
+        self.rack = rack
+        return
+
+
+class FakeKeyspace(object):
+
+    """The scheduler's tables, held in dicts keyed by primary key."""
+
+    def __init__(self, nodes, latency=0.0, connect_latency=0.0, replication_delay=0.0):
+        """
+        :param nodes: list of FakeNode
+        :param latency: seconds each query takes
+        :param connect_latency: seconds each new connection takes
+        :param replication_delay: seconds before a node's writes can be seen
+          by other nodes reading at consistency ONE
+        """
+        self.nodes = dict([(node.nodename, node) for node in nodes])
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.replication_delay = replication_delay
+        self.lock = threading.Lock()
+        self.tables = collections.defaultdict(dict) # table -> {key: (values, written, expires, writer)}
+        self.queries = collections.Counter()        # statement -> times run
+        self.queries_by_node = collections.Counter()
+        self.connections = 0
+        self.handlers = self.build_handlers()
+        return
+
+    def build_handlers(self):
+        """Map each of CqlWrapper's statements to what it does here.
+        :returns: dict of statement: function(reader, params, consistency_level)
+        """
+        W = CqlWrapper
+        handlers = {
+            W.SELECT_MY_DATACENTER: lambda reader, params, cl: [(reader.data_center,)],
+            W.SELECT_ALL_DATACENTERS: lambda reader, params, cl: [
+                (node.data_center,) for node in self.nodes.values() if node is not reader],
+            W.SELECT_MY_TOKENS: lambda reader, params, cl: [(set([str(reader.token)]), reader.rack)],
+            W.SELECT_PEER_TOKENS: lambda reader, params, cl: [
+                (node.nodename, node.nodename, node.data_center, set([str(node.token)]), node.rack)
+                for node in self.nodes.values() if node is not reader],
+            W.GET_STEPS: lambda reader, params, cl: [
+                (key[2], values['command'], values.get('exit_code'))
+                for key, values in self.select('repair_steps', reader, cl,
+                                               params['data_center'], params['nodename'])],
+            W.STEP_START: lambda reader, params, cl: self.write(
+                'repair_steps', reader, (params['data_center'], params['nodename'], params['step']),
+                params, ('command', 'started')),
+            W.STEP_FINISH: lambda reader, params, cl: self.write(
+                'repair_steps', reader, (params['data_center'], params['nodename'], params['step']),
+                params, ('finished', 'exit_code')),
+            W.STEPS_CLEANUP: lambda reader, params, cl: self.delete(
+                'repair_steps', params['data_center'], params['nodename']),
+            W.REPAIR_COPY: lambda reader, params, cl: self.write(
+                'repair_status_by_dc', reader, (params['data_center'], params['nodename']),
+                params, ('repair_status',)),
+            W.LEGACY_COPY_STATUS: lambda reader, params, cl: [],
+        }
+        for table, _ in W.ADDED_TABLES:
+            handlers[W.PROBE_TABLE.format(table=table)] = lambda reader, params, cl: []
+        # The status and MUTEX statements, for both sets of tables.  The
+        # keys are always held as (data_center, nodename).
+        for prefix, status, mutex in (('', 'repair_status_by_dc', 'mutex_by_dc'),
+                                      ('LEGACY_', 'repair_status', 'mutex')):
+            statement = lambda name: getattr(W, prefix + name)
+            handlers.update({
+                statement('GET_STATUS'): self.status_reader(status, lambda key, values: (values['repair_status'],)),
+                statement('GET_LOCAL_STATUS'): self.status_reader(status, lambda key, values: (key[1], values['repair_status'])),
+                statement('MUTEX_START'): self.writer(mutex, ()),
+                statement('MUTEX_CHECK'): self.status_reader(mutex, lambda key, values: (key[1], key[0])),
+                statement('MUTEX_CLEANUP'): self.deleter(mutex),
+                statement('REPAIR_START'): self.writer(status, (), repair_status='Started'),
+                statement('REPAIR_UPDATE'): self.writer(status, ('newstatus',)),
+                statement('REPAIR_CLEANUP'): self.deleter(status),
+            })
+        handlers[W.GET_DC_STATUS] = self.status_reader(
+            'repair_status_by_dc', lambda key, values: (key[1], key[0], values['repair_status'], values['writetime']))
+        return handlers
+
+    def status_reader(self, table, row):
+        """A handler returning row(key, values) for each matching record.
+        Whatever of data_center and nodename is given narrows it down."""
+        def handler(reader, params, cl):
+            key = [params[name] for name in ('data_center', 'nodename') if name in params]
+            return [row(found, values) for found, values in self.select(table, reader, cl, *key)]
+        return handler
+
+    def writer(self, table, names, **fixed):
+        """A handler writing the named parameters (and fixed values)."""
+        def handler(reader, params, cl):
+            values = dict(params, **fixed)
+            if 'newstatus' in values:
+                values['repair_status'] = values.pop('newstatus')
+            columns = fixed.keys() + [name == 'newstatus' and 'repair_status' or name for name in names]
+            return self.write(table, reader, (params['data_center'], params['nodename']), values, columns)
+        return handler
+
+    def deleter(self, table):
+        """A handler deleting one record."""
+        return lambda reader, params, cl: self.delete(table, params['data_center'], params['nodename'])
+
+    def select(self, table, reader, consistency_level, *prefix):
+        """Find live records whose key starts with prefix.
+        :returns: list of (key, values), in key order
+        """
+        now = time.time()
+        visible_after = consistency_level == 'ONE' and now - self.replication_delay or now
+        found = []
+        for key, (values, written, expires, writer) in self.tables[table].items():
+            if key[:len(prefix)] != prefix or expires < now:
+                continue
+            if written > visible_after and writer is not reader:
+                continue
+            found.append((key, values))
+        return sorted(found)
+
+    def write(self, table, reader, key, params, names):
+        """Insert or update the named values of one record."""
+        now = time.time()
+        old = self.tables[table].get(key)
+        values = old and old[2] > now and dict(old[0]) or {}
+        for name in names:
+            values[name] = params[name]
+        values['writetime'] = int(now * 1000000)
+        self.tables[table][key] = (values, now, now + params.get('ttl', 86400), reader)
+        return []
+
+    def delete(self, table, *prefix):
+        """Delete every record whose key starts with prefix."""
+        for key in self.tables[table].keys():
+            if key[:len(prefix)] == prefix:
+                del self.tables[table][key]
+        return []
+
+    def execute(self, reader, query_string, params, consistency_level):
+        """Run one statement.
+        :returns: list of rows
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        handler = self.handlers.get(query_string)
+        if handler is None:
+            raise NotImplementedError('FakeKeyspace has no idea what to do with: %s' % query_string)
+        with self.lock:
+            self.queries[query_string] += 1
+            self.queries_by_node[reader.nodename] += 1
+            return handler(reader, params or {}, consistency_level)
+
+
+class FakeConnection(object):
+
+    """A connection to FakeConnection.keyspace_data, as node option_group.hostname."""
+    keyspace_data = None
+    keeps_alive = True
+    available = True
+    DEFAULT_PORT = 9042
+
+    def __init__(self, option_group, keyspace):
+        self.data = self.keyspace_data
+        self.node = self.data.nodes[option_group.hostname]
+        if self.data.connect_latency:
+            time.sleep(self.data.connect_latency)
+        with self.data.lock:
+            self.data.connections += 1
+        return
+
+    def healthy(self):
+        return True
+
+    def execute(self, query_string, params=None, consistency_level="LOCAL_QUORUM", prepare=True):
+        return self.data.execute(self.node, query_string, params, consistency_level)
+
+    def close(self):
+        return
+
+
+cassandra_repair_scheduler.DRIVERS['fake'] = FakeConnection
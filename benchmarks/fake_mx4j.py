@@ -0,0 +1,363 @@
+#! /usr/bin/env python
+
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+A stand-in for the MX4J HTTP adaptor on every node of a Cassandra cluster,
+so that casstop (and stop_cassandra_repairs) can be run and measured
+without a real cluster.
+
+Each node gets its own loopback address (127.1.0.1, 127.1.0.2, ...), and
+one server listening on all of them answers as whichever node a request
+was sent to.  On Linux all of 127/8 is local, so nothing needs to be set
+up first:
+
+    fake_mx4j.py --nodes 500 --port 18081 &
+    casstop --port 18081 127.1.0.1
+
+The responses look like MX4J's for the MBeans casstop reads, through
+getattribute, mbean and invoke, and serverbydomain lists the thread pools
+and dropped message counters; anything else gets a made-up number.
+Values drift over time, and the counters count up from when the fake
+cluster started.  --latency, --slow, --dead and --failures make
+nodes slow or broken.
+"""
+
+import argparse
+import BaseHTTPServer
+import math
+import random
+import SocketServer
+import time
+import urlparse
+import xml.sax.saxutils
+
+from mx4j_parse_benchmark import (ATTRIBUTE_TEMPLATE, MBEAN_TEMPLATE, MBEAN_ATTRIBUTE,
+                                  LATENCY_ATTRIBUTES, compactions)
+
+OPERATION_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<MBeanOperation><Operation objectname="{objectname}" name="{name}" result="success" return="{value}" returnclass="java.lang.String"/></MBeanOperation>"""
+
+STORAGE_SERVICE = 'org.apache.cassandra.db:type=StorageService'
+COMPACTION_MANAGER = 'org.apache.cassandra.db:type=CompactionManager'
+FAILURE_DETECTOR = 'org.apache.cassandra.net:type=FailureDetector'
+CLIENT_LATENCY = 'org.apache.cassandra.metrics:type=ClientRequest,scope={0},name=Latency'
+OPERATING_SYSTEM = 'java.lang:type=OperatingSystem'
+METRICS = 'org.apache.cassandra.metrics'
+SERVER_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Server pattern="{pattern}"><Domain name="{domain}">
+{mbeans}
+</Domain></Server>"""
+SERVER_MBEAN = '<MBean classname="{classname}" description="" objectname="{objectname}"/>'
+
+# Thread pools: (path, stage, share of the node's reads and writes)
+THREAD_POOLS = [('request', 'ReadStage', 1.0), ('request', 'MutationStage', 1.0),
+                ('request', 'CounterMutationStage', 0.0), ('request', 'ReadRepairStage', 0.01),
+                ('request', 'RequestResponseStage', 0.5), ('internal', 'CompactionExecutor', 0.0001),
+                ('internal', 'MemtableFlushWriter', 0.0001), ('internal', 'MemtablePostFlush', 0.0001),
+                ('internal', 'GossipStage', 0.001), ('internal', 'AntiEntropyStage', 0.0),
+                ('internal', 'MigrationStage', 0.0), ('internal', 'ValidationExecutor', 0.0),
+                ('internal', 'InternalResponseStage', 0.0001), ('internal', 'HintedHandoff', 0.0)]
+DROPPED_VERBS = ['MUTATION', 'COUNTER_MUTATION', 'READ', 'RANGE_SLICE', 'PAGED_RANGE',
+                 'READ_REPAIR', 'REQUEST_RESPONSE', 'BINARY', '_TRACE']
+
+
+def node_address(index):
+    """The loopback address node number index answers on."""
+    return '127.1.%d.%d' % (index // 250, index % 250 + 1)
+
+
+def escape(value):
+    """Escape a value for an XML attribute, the way MX4J does."""
+    return xml.sax.saxutils.escape(str(value), {'"': '&quot;', '\n': '&#10;'})
+
+
+def properties(objectname):
+    """The domain and key properties of an objectname.
+    :returns: (domain, dict of key: value)
+    """
+    domain, _, keys = objectname.partition(':')
+    return domain, dict([key.partition('=')[::2] for key in keys.split(',') if key])
+
+
+class FakeNode(object):
+
+    """One node's made-up state.  Values wander around a per-node base
+    level, so that every refresh shows something different."""
+
+    def __init__(self, cluster, index, rng):
+        self.cluster = cluster
+        self.index = index
+        self.address = node_address(index)
+        self.data_center = 'dc%d' % (index % cluster.data_centers)
+        self.rack = 'rack%d' % (index // cluster.data_centers % 3)
+        self.token = index * (2 ** 64 // cluster.size) - 2 ** 63
+        self.load = rng.uniform(50, 500) * 2 ** 30
+        self.rates = {'Read': rng.uniform(10, 5000), 'Write': rng.uniform(10, 5000)}
+        self.latencies = {'Read': rng.uniform(200, 5000), 'Write': rng.uniform(20, 500)}
+        self.pending = rng.randint(0, 20)
+        self.compactions = rng.randint(0, 4)
+        self.phase = rng.uniform(0, 2 * math.pi)
+        self.dead = False
+        self.slow = False
+        return
+
+    def wobble(self, value, now, period=60.0):
+        """value, give or take 20%, varying with time."""
+        return value * (1 + 0.2 * math.sin(now / period + self.phase))
+
+    def gossip(self):
+        """This node's entry in AllEndpointStates (not yet escaped)."""
+        return ('/%s\n  generation:1418158812\n  heartbeat:%d\n  STATUS:NORMAL,%d\n  LOAD:%r\n'
+                '  DC:%s\n  RACK:%s\n  RELEASE_VERSION:2.0.11\n  RPC_ADDRESS:%s\n  SEVERITY:0.0\n'
+                % (self.address, 100000 + self.index, self.token, self.load,
+                   self.data_center, self.rack, self.address))
+
+    def mbean(self, objectname, now):
+        """Every attribute of one MBean.
+        :returns: dict of name: value, or None if it isn't one we know about
+        """
+        if objectname == STORAGE_SERVICE:
+            return {'ClusterName': self.cluster.name, 'OperationMode': 'NORMAL',
+                    'Load': self.wobble(self.load, now, 3600.0)}
+        if objectname == COMPACTION_MANAGER:
+            return {'PendingTasks': int(self.wobble(self.pending, now)),
+                    'Compactions': compactions(self.compactions)}
+        if objectname == FAILURE_DETECTOR:
+            return {'AllEndpointStates': self.cluster.gossip}
+        if objectname == OPERATING_SYSTEM:
+            return {'SystemLoadAverage': self.wobble(4.0, now)}
+        domain, keys = properties(objectname)
+        if domain == METRICS and keys.get('type') == 'ThreadPools':
+            return self.thread_pool(keys.get('scope'), keys.get('name'), now)
+        if domain == METRICS and keys.get('type') == 'DroppedMessage' and keys.get('name') == 'Dropped':
+            return self.dropped(keys.get('scope'), now)
+        for scope in ('Read', 'Write'):
+            if objectname == CLIENT_LATENCY.format(scope):
+                values = dict([(name, self.wobble(self.latencies[scope], now, 10.0))
+                               for name in LATENCY_ATTRIBUTES])
+                for name in ('OneMinuteRate', 'FiveMinuteRate', 'FifteenMinuteRate', 'MeanRate'):
+                    values[name] = self.wobble(self.rates[scope], now, 30.0)
+                values['Count'] = int(self.rates[scope] * now) % 2 ** 31
+                values['DurationUnit'] = 'microseconds'
+                values['RateUnit'] = 'events/second'
+                return values
+        return None
+
+    def thread_pool(self, stage, metric, now):
+        """One metric of one thread pool.  Slow nodes have a backlog, and
+        block now and then.
+        :returns: dict of name: value, or None for a pool we don't have
+        """
+        shares = dict([(name, share) for _, name, share in THREAD_POOLS])
+        if not stage in shares:
+            return None
+        rate = shares[stage] * (self.rates['Read'] + self.rates['Write'])
+        backlog = self.slow and shares[stage] and 200.0 or 0.0
+        uptime = now - self.cluster.started
+        values = {'ActiveTasks': {'Value': int(self.wobble(min(rate / 100, 32), now, 5.0))},
+                  'PendingTasks': {'Value': int(self.wobble(backlog + rate / 1000, now, 5.0))},
+                  'CompletedTasks': {'Value': int(rate * uptime)},
+                  'CurrentlyBlockedTasks': {'Count': int(backlog / 100)},
+                  'TotalBlockedTasks': {'Count': int(backlog / 100 * uptime)},
+                  'MaxPoolSize': {'Value': 32}}
+        return values.get(metric)
+
+    def dropped(self, verb, now):
+        """How many messages of one kind this node has dropped.  Slow nodes
+        drop a share of their mutations and reads."""
+        if not verb in DROPPED_VERBS:
+            return None
+        shares = {'MUTATION': self.rates['Write'], 'READ': self.rates['Read'],
+                  'REQUEST_RESPONSE': self.rates['Read'] / 10}
+        rate = self.slow and shares.get(verb, 0.0) / 100 or 0.0
+        return {'Count': int(rate * (now - self.cluster.started))}
+
+    def attribute(self, objectname, name, now):
+        """One attribute; a made-up number for anything we don't model."""
+        values = self.mbean(objectname, now)
+        if values and name in values:
+            return values[name]
+        return (hash((objectname, name)) + self.index) % 1000
+
+
+class FakeCluster(object):
+
+    """All of the nodes, and how badly they behave."""
+
+    def __init__(self, options):
+        rng = random.Random(options.seed)
+        self.name = options.cluster_name
+        self.size = options.nodes
+        self.data_centers = options.data_centers
+        self.latency = options.latency / 1000.0
+        self.slow_latency = options.slow_latency
+        self.failures = options.failures
+        self.nodes = [FakeNode(self, index, rng) for index in range(options.nodes)]
+        for node in rng.sample(self.nodes, int(options.slow * self.size)):
+            node.slow = True
+        for node in rng.sample(self.nodes, int(options.dead * self.size)):
+            node.dead = True
+        self.by_address = dict([(node.address, node) for node in self.nodes])
+        self.gossip = ''.join([node.gossip() for node in self.nodes])
+        self.requests = 0
+        self.started = time.time()
+        return
+
+    def query_names(self, pattern):
+        """The objectnames of the thread pool and dropped message MBeans
+        matching an MX4J query pattern (e.g. "domain:type=ThreadPools,*").
+        :returns: list of (classname, objectname)
+        """
+        domain, keys = properties(pattern)
+        wildcard = keys.pop('*', None) is not None
+        names = [('com.yammer.metrics.reporting.JmxReporter$Gauge',
+                  'type=ThreadPools,path=%s,scope=%s,name=%s' % (path, stage, metric))
+                 for path, stage, _ in THREAD_POOLS
+                 for metric in ('ActiveTasks', 'PendingTasks', 'CompletedTasks', 'MaxPoolSize')]
+        names += [('com.yammer.metrics.reporting.JmxReporter$Counter',
+                   'type=ThreadPools,path=%s,scope=%s,name=%s' % (path, stage, metric))
+                  for path, stage, _ in THREAD_POOLS for metric in ('CurrentlyBlockedTasks', 'TotalBlockedTasks')]
+        names += [('com.yammer.metrics.reporting.JmxReporter$Meter', 'type=DroppedMessage,scope=%s,name=Dropped' % verb)
+                  for verb in DROPPED_VERBS]
+        found = []
+        for classname, name in names:
+            objectname = '%s:%s' % (METRICS, name)
+            have = properties(objectname)[1]
+            if domain not in (METRICS, '*'):
+                continue
+            if wildcard and all([have.get(key) == value for key, value in keys.items()]) or have == keys:
+                found.append((classname, objectname))
+        return sorted(found)
+
+    def respond(self, node, path, query):
+        """Build the response to one request.
+        :returns: (HTTP status, body)
+        """
+        now = time.time()
+        objectname = query.get('objectname', '')
+        if path == '/getattribute':
+            name = query.get('attribute', '')
+            return 200, ATTRIBUTE_TEMPLATE.format(objectname=escape(objectname), name=escape(name),
+                                                  value=escape(node.attribute(objectname, name, now)))
+        if path == '/mbean':
+            values = node.mbean(objectname, now)
+            if values is None:
+                return 404, 'No such MBean: %s' % objectname
+            attributes = '\n'.join([MBEAN_ATTRIBUTE.format(name=escape(name), value=escape(value))
+                                    for name, value in sorted(values.items())])
+            return 200, MBEAN_TEMPLATE.format(objectname=escape(objectname), attributes=attributes)
+        if path == '/serverbydomain':
+            pattern = query.get('querynames', '*:*')
+            mbeans = '\n'.join([SERVER_MBEAN.format(classname=escape(classname), objectname=escape(objectname))
+                                for classname, objectname in self.query_names(pattern)])
+            return 200, SERVER_TEMPLATE.format(pattern=escape(pattern), domain=METRICS, mbeans=mbeans)
+        if path == '/invoke':
+            return 200, OPERATION_TEMPLATE.format(objectname=escape(objectname),
+                                                  name=escape(query.get('operation', '')), value='')
+        return 404, 'Unknown view: %s' % path
+
+
+class FakeMX4JHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answers as the node whose address the request came in on."""
+    protocol_version = 'HTTP/1.1'
+    timeout = 60                # Drop idle keep-alive connections
+
+    def do_GET(self):
+        cluster = self.server.cluster
+        cluster.requests += 1
+        node = cluster.by_address.get(self.connection.getsockname()[0])
+        if node is None:
+            return self.reply(404, 'No node at %s' % self.connection.getsockname()[0])
+        if node.dead:
+            # Like a hung JVM: the connection is accepted, but that's all.
+            time.sleep(3600)
+            return
+        delay = node.slow and cluster.slow_latency or cluster.latency
+        if delay:
+            time.sleep(random.expovariate(1.0 / delay))
+        if cluster.failures and random.random() < cluster.failures:
+            return self.reply(500, 'Injected failure')
+        path, _, query = self.path.partition('?')
+        query = dict(urlparse.parse_qsl(query))
+        return self.reply(*cluster.respond(node, path, query))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+        return
+
+
+class FakeMX4JServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """One thread per connection, listening on every address."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, cluster, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeMX4JHandler)
+        self.cluster = cluster
+        self.verbose = verbose
+        return
+
+
+def cli_parsing(args=None):
+    """Parse the command line.
+    :param args: arguments to parse instead of sys.argv
+    :returns: option set
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, default=100,
+                        help="Nodes in the cluster (default: %(default)d)")
+    parser.add_argument("-p", "--port", type=int, default=18081,
+                        help="Port to listen on (default: %(default)d)")
+    parser.add_argument("--data-centers", type=int, default=2,
+                        help="Data centers to spread the nodes across (default: %(default)d)")
+    parser.add_argument("--cluster-name", default="Fake Cluster",
+                        help="Cluster name (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Mean milliseconds to take over each response (default: %(default)g)")
+    parser.add_argument("--slow", type=float, default=0.0,
+                        help="Fraction of nodes that are slow to answer (default: %(default)g)")
+    parser.add_argument("--slow-latency", type=float, default=5.0,
+                        help="Mean seconds a slow node takes to answer (default: %(default)g)")
+    parser.add_argument("--dead", type=float, default=0.0,
+                        help="Fraction of nodes that accept connections but never answer (default: %(default)g)")
+    parser.add_argument("--failures", type=float, default=0.0,
+                        help="Fraction of requests that get an HTTP 500 (default: %(default)g)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the node values and which nodes misbehave (default: %(default)d)")
+    parser.add_argument("-v", "--verbose", action='store_true', default=False,
+                        help="Log every request")
+    options = parser.parse_args(args)
+    if not 0 < options.nodes <= 250 * 256:
+        parser.error('--nodes must be between 1 and %d' % (250 * 256))
+    return options
+
+
+def main():
+    """Main entry point."""
+    options = cli_parsing()
+    cluster = FakeCluster(options)
+    server = FakeMX4JServer(('0.0.0.0', options.port), cluster, options.verbose)
+    print 'Serving %d nodes, %s to %s, on port %d' % (options.nodes, node_address(0),
+                                                      node_address(options.nodes - 1), options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print '%d requests' % cluster.requests
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+Compare casstop's ring-buffer MovingAverages (and DecayingAverages) with
+the deque-based implementation it replaced.
+
+Each run feeds 15 minutes' worth of warm-up samples at the given interval,
+then times further adds, so every window is full.  casstop takes one sample
+per refresh (3 seconds by default) per latency item per host.
+"""
+
+import argparse
+import collections
+import random
+import sys
+import time
+
+import casstop_loader
+
+
+class DequeMovingAverages(object):
+    '''The original casstop implementation, with "now" passed in.'''
+    def __init__(self):
+        self.queue = collections.deque() # Where we keep our data stashed away
+        self.one = self.five = self.fifteen = 0.0
+        return
+    def add(self, value, now):
+        self.queue.appendleft((value, now))
+        # These two lines discard old stuff
+        old = now - 900         # 15 minutes
+        while self.queue and self.queue[-1][1] < old: del self.queue[-1]
+        total = 0.0
+        count = 0
+
+        then = now - 60
+        while count < len(self.queue):
+            value, timestamp = self.queue[count]
+            if timestamp < then: break
+            count += 1
+            total += value
+        self.one = total/count
+
+        then = now - 300
+        while count < len(self.queue):
+            value, timestamp = self.queue[count]
+            if timestamp < then: break
+            count += 1
+            total += value
+        self.five = total/count
+
+        while count < len(self.queue):
+            value, timestamp = self.queue[count]
+            count += 1
+            total += value
+        self.fifteen = total/count
+        return self
+
+
+def deque_size(averages):
+    """Approximate bytes held by a DequeMovingAverages."""
+    size = sys.getsizeof(averages.queue)
+    for entry in averages.queue:
+        size += sys.getsizeof(entry) + sys.getsizeof(entry[0]) + sys.getsizeof(entry[1])
+    return size
+
+
+def ring_size(averages):
+    """Approximate bytes held by a MovingAverages."""
+    return sys.getsizeof(averages.values) + sys.getsizeof(averages.stamps)
+
+
+def run(averages, samples, interval, adds):
+    """Warm up, then time adds.
+    :returns: (microseconds per add, averages)
+    """
+    now = 1000000.0
+    for value in samples[:int(900 / interval) + 1]:
+        now += interval
+        averages.add(value, now)
+    timed = samples[-adds:]
+    start = time.time()
+    for value in timed:
+        now += interval
+        averages.add(value, now)
+    return (time.time() - start) / adds * 1000000.0, averages
+
+
+def cli_parsing():
+    """Parse the command line.
+    :returns: option set
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--interval", type=float, action="append",
+                        help="Seconds between samples; may be repeated (default: 3, 1 and 0.1)")
+    parser.add_argument("-a", "--adds", type=int, default=20000,
+                        help="Timed adds per run (default: %(default)d)")
+    return parser.parse_args()
+
+
+def main():
+    """Main entry point."""
+    options = cli_parsing()
+    casstop = casstop_loader.load_casstop()
+    print '%8s %8s %10s %10s %10s %10s %10s %10s' % ('interval', 'window', 'deque us', 'ring us',
+                                                  'decay us', 'deque B', 'ring B', 'max error')
+    for interval in options.interval or [3.0, 1.0, 0.1]:
+        samples = [random.random() for _ in xrange(int(900 / interval) + 1 + options.adds)]
+        old_time, old = run(DequeMovingAverages(), samples, interval, options.adds)
+        new_time, new = run(casstop.MovingAverages(), samples, interval, options.adds)
+        decay_time, _ = run(casstop.DecayingAverages(), samples, interval, options.adds)
+        error = max(abs(old.one - new.one), abs(old.five - new.five), abs(old.fifteen - new.fifteen))
+        print '%8.2f %8d %10.2f %10.2f %10.2f %10d %10d %10.2g' % (interval, len(old.queue), old_time, new_time,
+                                                               decay_time, deque_size(old), ring_size(new), error)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+Compare casstop's expat-based MX4J value extraction with the xmltodict
+parsing it replaced.
+
+By default a set of synthetic responses, shaped like the ones MX4J returns
+for the MBeans casstop reads, is used.  Captured responses can be timed as
+well (e.g. "curl -o load.xml 'http://node:8081/getattribute?...'"):
+
+    mx4j_parse_benchmark.py --payload getattribute:load.xml --payload mbean:latency.xml
+"""
+
+import argparse
+import timeit
+
+import casstop_loader
+
+try:
+    import xmltodict
+except ImportError:
+    xmltodict = None
+
+ATTRIBUTE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<MBean objectname="{objectname}"><Attribute classname="java.lang.String" isnull="false" name="{name}" value="{value}"/></MBean>"""
+
+MBEAN_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<MBean classname="com.yammer.metrics.reporting.JmxReporter$Timer" description="Information on the management interface of the MBean" objectname="{objectname}">
+{attributes}
+<Constructor description="Public constructor of the MBean" name="com.yammer.metrics.reporting.JmxReporter$Timer"/>
+<Operation description="Operation exposed for management" impact="unknown" name="values" return="[D"/>
+</MBean>"""
+
+MBEAN_ATTRIBUTE = """<Attribute aggregation="simple" availability="RO" description="Attribute exposed for management" isnull="false" name="{name}" strinit="false" type="double" value="{value}"/>"""
+
+LATENCY_ATTRIBUTES = ['50thPercentile', '75thPercentile', '95thPercentile', '98thPercentile',
+                      '999thPercentile', '99thPercentile', 'Count', 'DurationUnit',
+                      'FifteenMinuteRate', 'FiveMinuteRate', 'Max', 'Mean', 'MeanRate',
+                      'Min', 'OneMinuteRate', 'RateUnit', 'StdDev']
+
+
+def endpoint_states(nodes):
+    """Something that looks like FailureDetector.AllEndpointStates.
+    :param nodes: number of endpoints
+    :returns: attribute value, already XML-escaped
+    """
+    rows = []
+    for n in range(nodes):
+        rows.append('/10.%d.%d.%d&#10;  generation:1418158812&#10;  heartbeat:%d&#10;'
+                    '  STATUS:NORMAL,-%d&#10;  LOAD:1.2345678E11&#10;  SCHEMA:59adb24e-f3cd-3e02-97f0-5b395827453f&#10;'
+                    '  DC:dc%d&#10;  RACK:rack%d&#10;  RELEASE_VERSION:2.0.11&#10;  INTERNAL_IP:10.%d.%d.%d&#10;'
+                    '  RPC_ADDRESS:10.%d.%d.%d&#10;  SEVERITY:0.0&#10;  NET_VERSION:7&#10;  HOST_ID:%08x-0000-0000-0000-000000000000&#10;'
+                    % ((n / 65536, (n / 256) % 256, n % 256, 100000 + n, n * 7919, n % 3, n % 5)
+                       + (n / 65536, (n / 256) % 256, n % 256) * 2 + (n,)))
+    return ''.join(rows)
+
+
+def compactions(count):
+    """Something that looks like CompactionManager.Compactions.
+    :param count: number of running compactions
+    :returns: attribute value, already XML-escaped
+    """
+    return '[' + ', '.join(['{id=%d, keyspace=ks, columnfamily=cf%d, completed=%d, total=%d, '
+                            'taskType=Compaction, unit=bytes}' % (n, n, n * 1000, n * 5000 + 1)
+                            for n in range(count)]) + ']'
+
+
+def synthetic_payloads(nodes):
+    """Build the default set of responses.
+    :param nodes: cluster size to use for AllEndpointStates
+    :returns: list of (label, kind, names, document)
+    """
+    latency = 'org.apache.cassandra.metrics:type=ClientRequest,scope=Read,name=Latency'
+    return [
+        ('Load', 'getattribute', None,
+         ATTRIBUTE_TEMPLATE.format(objectname='org.apache.cassandra.db:type=StorageService',
+                                   name='Load', value='1.2345678E11')),
+        ('Compactions (20)', 'getattribute', None,
+         ATTRIBUTE_TEMPLATE.format(objectname='org.apache.cassandra.db:type=CompactionManager',
+                                   name='Compactions', value=compactions(20))),
+        ('AllEndpointStates (%d)' % nodes, 'getattribute', None,
+         ATTRIBUTE_TEMPLATE.format(objectname='org.apache.cassandra.net:type=FailureDetector',
+                                   name='AllEndpointStates', value=endpoint_states(nodes))),
+        ('Read latency MBean', 'mbean', ['75thPercentile', 'OneMinuteRate', 'FiveMinuteRate', 'FifteenMinuteRate'],
+         MBEAN_TEMPLATE.format(objectname=latency, attributes='\n'.join(
+             [MBEAN_ATTRIBUTE.format(name=name, value=1234.5678) for name in LATENCY_ATTRIBUTES]))),
+    ]
+
+
+def xmltodict_extract(kind, names, document):
+    """What casstop used to do with a response."""
+    data = xmltodict.parse(document)
+    if kind == 'getattribute':
+        return data['MBean']['Attribute']['@value']
+    values = {}
+    for attribute in data['MBean']['Attribute']:
+        if attribute.get('@name') in names:
+            values[attribute['@name']] = attribute.get('@value')
+    return values
+
+
+def expat_extract(casstop, kind, names, document):
+    """What casstop does with a response now."""
+    if kind == 'getattribute':
+        return casstop.extract_mx4j_values(document, limit=1).values()[0]
+    return casstop.extract_mx4j_values(document, names=set(names))
+
+
+def best_time(function, number, repeat):
+    """Best per-call time, in microseconds."""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1000000.0
+
+
+def cli_parsing():
+    """Parse the command line.
+    :returns: option set
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, default=300,
+                        help="Endpoints in the synthetic AllEndpointStates (default: %(default)d)")
+    parser.add_argument("--number", type=int, default=200,
+                        help="Parses per timing run (default: %(default)d)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Timing runs; the best is reported (default: %(default)d)")
+    parser.add_argument("--payload", action="append", default=[], metavar="KIND:FILE",
+                        help="Captured response to time as well; KIND is getattribute or mbean.  "
+                        "For mbean, append :Attr1,Attr2 to choose the attributes extracted")
+    return parser.parse_args()
+
+
+def main():
+    """Main entry point."""
+    options = cli_parsing()
+    casstop = casstop_loader.load_casstop()
+    payloads = synthetic_payloads(options.nodes)
+    for spec in options.payload:
+        kind, filename = spec.split(':', 1)
+        names = LATENCY_ATTRIBUTES
+        if kind == 'mbean' and ':' in filename:
+            filename, names = filename.split(':', 1)
+            names = names.split(',')
+        payloads.append((filename, kind, names, open(filename).read()))
+
+    if not xmltodict:
+        print 'xmltodict is not installed, only timing the expat extractor'
+    print '%-28s %10s %12s %12s %8s' % ('payload', 'bytes', 'xmltodict us', 'expat us', 'speedup')
+    for label, kind, names, document in payloads:
+        new = best_time(lambda: expat_extract(casstop, kind, names, document), options.number, options.repeat)
+        if xmltodict:
+            if xmltodict_extract(kind, names, document) != expat_extract(casstop, kind, names, document):
+                print '%s: results differ!' % label
+            old = best_time(lambda: xmltodict_extract(kind, names, document), options.number, options.repeat)
+            print '%-28s %10d %12.1f %12.1f %7.1fx' % (label, len(document), old, new, old / new)
+        else:
+            print '%-28s %10d %12s %12.1f %8s' % (label, len(document), '-', new, '-')
+
+
+if __name__ == '__main__':
+    main()
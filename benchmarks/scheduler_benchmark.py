@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+
+# Author: Brian Gallew <bgallew@llnw.com> or <geek@gallew.org>
+
+"""
+Run the repair scheduler on every node of a fake cluster at once, the way
+cron does, against fake_cql.py instead of Cassandra.
+
+Each node (a thread here) runs check_should_run, and the nodes that get
+in claim their repair and run it.  The repair steps come from a stand-in
+for range_repair.py, and just sleep for --step-time.  It reports how many
+nodes in each data center ended up repairing at once (more than
+--nodes-per-dc, or any pair whose replicas overlap, means the MUTEX let
+them down), how long the check and the repair took, and how many queries
+and connections each node needed:
+
+    scheduler_benchmark.py --nodes 60 --nodes-per-dc 2 --replication-delay 500
+
+--latency, --connect-latency and --replication-delay make the fake
+Cassandra slow or inconsistent; --reconnect makes every connection behave
+like the Thrift driver's, which doesn't survive a repair step.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import fake_cql
+import cassandra_repair_scheduler
+
+PLAN_SCRIPT = """#! /bin/sh
+for step in $(seq {steps}); do echo "$step/{steps} sleep {step_time}"; done
+"""
+
+
+def build_cluster(options):
+    """Spread the nodes over the data centers, evenly around each ring.
+    :returns: FakeKeyspace
+    """
+    nodes = []
+    for index in range(options.nodes):
+        data_center = index % options.data_centers
+        place = index // options.data_centers
+        size = len(range(data_center, options.nodes, options.data_centers))
+        token = place * (2 ** 64 // size) - 2 ** 63 + data_center
+        nodes.append(fake_cql.FakeNode('node%04d' % index, 'dc%d' % data_center, token,
+                                       'rack%d' % (place % options.racks)))
+    return fake_cql.FakeKeyspace(nodes, options.latency / 1000.0, options.connect_latency / 1000.0,
+                                 options.replication_delay / 1000.0)
+
+
+def scheduler_options(options, state_dir):
+    """Build the scheduler's own options, as its command line would.
+    :returns: option set, with the hostname still to be filled in
+    """
+    arguments = ['scheduler', '--driver', 'fake', '--state-dir', state_dir,
+                 '--range_repair_tool', os.path.join(state_dir, 'range_repair'),
+                 '--parallel', str(options.parallel), '--nodes-per-dc', str(options.nodes_per_dc),
+                 '--replication-factor', str(options.replication_factor),
+                 '--legacy-tables', options.legacy_tables] + (options.debug and ['--debug'] or [])
+    saved, sys.argv = sys.argv, arguments
+    try:
+        return cassandra_repair_scheduler.cli_parsing()
+    finally:
+        sys.argv = saved
+
+
+def run_node(nodename, base, results):
+    """What one node's cron job does.  Fills in results[nodename]."""
+    option_group = argparse.Namespace(**vars(base))
+    option_group.hostname = nodename
+    result = results[nodename] = {'claimed': False}
+    start = time.time()
+    connection = cassandra_repair_scheduler.CqlWrapper(option_group)
+    try:
+        result['claimed'] = connection.check_should_run()
+        result['check'] = time.time() - start
+        if result['claimed']:
+            connection.claim_repair()
+            result['claimed_at'] = time.time()
+            connection.run_repair()
+            result['finished_at'] = time.time()
+    finally:
+        connection.close()
+    return
+
+
+def concurrent(results, nodenames):
+    """The most of these nodes that were repairing at the same time."""
+    events = []
+    for nodename in nodenames:
+        events.append((results[nodename]['claimed_at'], 1))
+        events.append((results[nodename]['finished_at'], -1))
+    most = running = 0
+    for _, change in sorted(events):
+        running += change
+        most = max(most, running)
+    return most
+
+
+def overlapping(keyspace, options, nodenames):
+    """Count the pairs of these nodes whose replicas overlap."""
+    tokens = sorted([keyspace.nodes[nodename].token for nodename in nodenames])
+    ring = sorted([node.token for node in keyspace.nodes.values()
+                   if node.data_center == keyspace.nodes[nodenames[0]].data_center])
+    places = [ring.index(token) for token in tokens]
+    pairs = 0
+    for left in range(len(places)):
+        for right in range(left + 1, len(places)):
+            distance = abs(places[left] - places[right])
+            if min(distance, len(ring) - distance) < 2 * options.replication_factor - 1:
+                pairs += 1
+    return pairs
+
+
+def median(values):
+    """The middle value, or 0.0 if there aren't any."""
+    values = sorted(values)
+    return values and values[len(values) / 2] or 0.0
+
+
+def report(keyspace, options, results, wall):
+    """Print the results."""
+    print '%-12s %6s %9s %11s %11s' % ('data center', 'nodes', 'repaired', 'concurrent', 'overlapping')
+    for data_center in sorted(set([node.data_center for node in keyspace.nodes.values()])):
+        members = [name for name, node in keyspace.nodes.items() if node.data_center == data_center]
+        claimed = [name for name in members if results[name]['claimed']]
+        print '%-12s %6d %9d %11d %11d' % (data_center, len(members), len(claimed),
+                                           claimed and concurrent(results, claimed) or 0,
+                                           claimed and overlapping(keyspace, options, claimed) or 0)
+    checks = [result['check'] for result in results.values() if 'check' in result]
+    repairs = [result['finished_at'] - result['claimed_at'] for result in results.values() if result['claimed']]
+    print
+    print 'check_should_run: median %.3fs, slowest %.3fs' % (median(checks), max(checks or [0.0]))
+    print 'repair (%d steps): median %.3fs, slowest %.3fs' % (options.steps, median(repairs), max(repairs or [0.0]))
+    queries = [keyspace.queries_by_node[name] for name in keyspace.nodes]
+    print 'queries per node: mean %.1f, most %d; connections per node: %.1f' % (
+        float(sum(queries)) / len(queries), max(queries), float(keyspace.connections) / len(queries))
+    print 'wall clock: %.3fs' % wall
+    return
+
+
+def cli_parsing():
+    """Parse the command line.
+    :returns: option set
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, default=30,
+                        help="Nodes in the cluster (default: %(default)d)")
+    parser.add_argument("--data-centers", type=int, default=3,
+                        help="Data centers to spread the nodes across (default: %(default)d)")
+    parser.add_argument("--racks", type=int, default=1,
+                        help="Racks in each data center (default: %(default)d)")
+    parser.add_argument("--nodes-per-dc", type=int, default=1,
+                        help="Scheduler --nodes-per-dc (default: %(default)d)")
+    parser.add_argument("--replication-factor", type=int, default=3,
+                        help="Scheduler --replication-factor (default: %(default)d)")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Scheduler --parallel (default: %(default)d)")
+    parser.add_argument("--legacy-tables", choices=['none', 'write', 'read'], default='none',
+                        help="Scheduler --legacy-tables (default: %(default)s)")
+    parser.add_argument("-s", "--steps", type=int, default=10,
+                        help="Repair steps per node (default: %(default)d)")
+    parser.add_argument("--step-time", type=float, default=0.1,
+                        help="Seconds each repair step takes (default: %(default)g)")
+    parser.add_argument("--mutex-pause", type=float, default=1.0,
+                        help="Seconds to wait between writing and checking the MUTEX (default: %(default)g)")
+    parser.add_argument("--latency", type=float, default=1.0,
+                        help="Milliseconds each query takes (default: %(default)g)")
+    parser.add_argument("--connect-latency", type=float, default=0.0,
+                        help="Milliseconds each connection takes to set up (default: %(default)g)")
+    parser.add_argument("--replication-delay", type=float, default=0.0,
+                        help="Milliseconds before other nodes see a write at consistency ONE "
+                        "(default: %(default)g)")
+    parser.add_argument("--reconnect", action='store_true', default=False,
+                        help="Drop the connection during repair steps, like the Thrift driver")
+    parser.add_argument("-d", "--debug", action='store_true', default=False,
+                        help="Show the scheduler's logging")
+    options = parser.parse_args()
+    if options.data_centers < 1 or options.nodes < options.data_centers:
+        parser.error('need at least one node in each data center')
+    if options.racks < 1:
+        parser.error('need at least one rack')
+    return options
+
+
+def main():
+    """Main entry point."""
+    options = cli_parsing()
+    keyspace = build_cluster(options)
+    fake_cql.FakeConnection.keyspace_data = keyspace
+    fake_cql.FakeConnection.keeps_alive = not options.reconnect
+    cassandra_repair_scheduler.CqlWrapper.MUTEX_PAUSE = options.mutex_pause
+    cassandra_repair_scheduler.RepairExecutor.POLL_INTERVAL = min(0.1, options.step_time or 0.1)
+    state_dir = tempfile.mkdtemp(prefix='scheduler_benchmark.')
+    try:
+        plan = os.path.join(state_dir, 'range_repair')
+        with open(plan, 'w') as script:
+            script.write(PLAN_SCRIPT.format(steps=options.steps, step_time=options.step_time))
+        os.chmod(plan, 0755)
+        base = scheduler_options(options, state_dir)
+        results = {}
+        threads = [threading.Thread(target=run_node, args=(nodename, base, results))
+                   for nodename in sorted(keyspace.nodes)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.time() - start
+    finally:
+        shutil.rmtree(state_dir)
+    report(keyspace, options, results, wall)
+
+
+if __name__ == '__main__':
+    main()
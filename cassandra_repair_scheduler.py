@@ -26,21 +26,285 @@ import argparse
 import platform
 import getpass
 import time
+import fcntl
+import hashlib
+import json
+import os
+import socket
 import subprocess
-import cql
 import curses
 import curses.wrapper
+import errno
+import stat
 import threading
+import urllib2
+import xml.etree.ElementTree
+
+try:
+    import cassandra
+    import cassandra.auth
+    import cassandra.cluster
+    import cassandra.query
+except ImportError:
+    cassandra = None
+try:
+    import cql
+except ImportError:
+    cql = None
 
 COMPLETED = "Completed"
 DELAY = 'delay'
 
+
+class NativeConnection(object):
+
+    """A native protocol session, using the DataStax cassandra-driver.
+
+    Each statement is prepared the first time it is used and the prepared
+    form reused after that, so a query is a single round trip.  The driver
+    keeps a pool of connections to each node, heartbeats them while they're
+    idle and reconnects in the background, so the session can be held across
+    long-running repair steps.
+    """
+    keeps_alive = True
+    available = cassandra is not None
+    HEARTBEAT = 30              # Seconds between heartbeats on idle connections
+    DEFAULT_PORT = 9042
+
+    def __init__(self, option_group, keyspace):
+        """Connect to the cluster.
+        :param option_group: result of CLI parsing
+        :param keyspace: keyspace to use
+        """
+        auth_provider = None
+        if option_group.username:
+            auth_provider = cassandra.auth.PlainTextAuthProvider(username=option_group.username,
+                                                                 password=option_group.password)
+        self.cluster = cassandra.cluster.Cluster([option_group.hostname],
+                                                 port=option_group.port,
+                                                 auth_provider=auth_provider,
+                                                 idle_heartbeat_interval=self.HEARTBEAT)
+        self.session = self.cluster.connect(keyspace)
+        # Rows as plain tuples, the same as the cql module returns.
+        self.session.row_factory = cassandra.query.tuple_factory
+        self.prepared = {}
+        return
+
+    def healthy(self):
+        """Check that the session can still be used.
+        :returns: boolean
+        """
+        if self.session.is_shutdown:
+            return False
+        return any([host.is_up for host in self.cluster.metadata.all_hosts()])
+
+    def execute(self, query_string, params=None, consistency_level="LOCAL_QUORUM", prepare=True):
+        """Execute a statement.
+        :param query_string: CQL to perform
+        :param params: dictionary of values for the named bind markers
+        :param consistency_level: consistency level name
+        :param prepare: False for statements that shouldn't be prepared (e.g. DDL)
+        :returns: list of rows
+        """
+        if not prepare:
+            return list(self.session.execute(query_string) or [])
+        statement = self.prepared.get(query_string)
+        if statement is None:
+            logging.debug("Preparing: %s", query_string)
+            statement = self.prepared[query_string] = self.session.prepare(query_string)
+        bound = statement.bind(params or {})
+        bound.consistency_level = cassandra.ConsistencyLevel.name_to_value[consistency_level]
+        return list(self.session.execute(bound) or [])
+
+    def close(self):
+        """Shut down the session and its connections."""
+        self.cluster.shutdown()
+        return
+
+
+class ThriftConnection(object):
+
+    """A Thrift connection, using the cql module.  Every statement is sent
+    as text, and the connection is dropped while a repair step runs in case
+    the server times it out.
+    """
+    keeps_alive = False
+    available = cql is not None
+    DEFAULT_PORT = 9160
+
+    def __init__(self, option_group, keyspace):
+        """Connect to the cluster.
+        :param option_group: result of CLI parsing
+        :param keyspace: keyspace to use
+        """
+        self.conn = cql.connect(option_group.hostname,
+                                option_group.port,
+                                keyspace,
+                                user=option_group.username,
+                                password=option_group.password,
+                                cql_version=option_group.cqlversion)
+        return
+
+    def healthy(self):
+        """There's no cheap way to tell, so assume so.
+        :returns: boolean
+        """
+        return True
+
+    def execute(self, query_string, params=None, consistency_level="LOCAL_QUORUM", prepare=True):
+        """Execute a statement.
+        :param query_string: CQL to perform
+        :param params: dictionary to use for parameter substitution in the CQL
+        :param consistency_level: consistency level name
+        :param prepare: ignored
+        :returns: list of rows
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(query_string.encode('ascii'), params or {}, consistency_level=consistency_level)
+        data = cursor.fetchall()
+        cursor.close()
+        return data
+
+    def close(self):
+        """Close the connection."""
+        self.conn.close()
+        return
+
+
+DRIVERS = {'native': NativeConnection, 'thrift': ThriftConnection}
+
+
+class BackPressure(object):
+
+    """Decide whether the node is too busy for more repair work, from its
+    pending compactions and load average as read over MX4J.
+    """
+    MX4J_URL = 'http://{host}:{port}/getattribute?objectname={objectname}&attribute={attribute}&template=identity'
+    PENDING_COMPACTIONS = ('org.apache.cassandra.db%3Atype%3DCompactionManager', 'PendingTasks')
+    LOAD_AVERAGE = ('java.lang%3Atype%3DOperatingSystem', 'SystemLoadAverage')
+    CHECK_INTERVAL = 10         # Seconds to reuse a reading for
+    TIMEOUT = 5
+
+    def __init__(self, host, port, max_pending_compactions, max_load):
+        """
+        :param host: node to ask
+        :param port: MX4J port
+        :param max_pending_compactions: busy above this many, 0 to ignore
+        :param max_load: busy above this load average, 0 to ignore
+        """
+        self.host = host
+        self.port = port
+        self.limits = []
+        if max_pending_compactions:
+            self.limits.append((self.PENDING_COMPACTIONS, max_pending_compactions))
+        if max_load:
+            self.limits.append((self.LOAD_AVERAGE, max_load))
+        self.checked = 0
+        self.reason = None
+        return
+
+    def read(self, objectname, attribute):
+        """Read one numeric attribute.
+        :returns: float
+        """
+        url = self.MX4J_URL.format(host=self.host, port=self.port, objectname=objectname, attribute=attribute)
+        document = xml.etree.ElementTree.fromstring(urllib2.urlopen(url, timeout=self.TIMEOUT).read())
+        return float(document.find('Attribute').get('value'))
+
+    def busy(self):
+        """Check whether any of the limits is exceeded.
+        :returns: why the node is busy, or None
+        """
+        if time.time() - self.checked < self.CHECK_INTERVAL:
+            return self.reason
+        self.checked = time.time()
+        self.reason = None
+        for (objectname, attribute), limit in self.limits:
+            try:
+                value = self.read(objectname, attribute)
+            except Exception as e:
+                logging.warning("Unable to read %s from %s, ignoring it: %s", attribute, self.host, e)
+                continue
+            if value > limit:
+                self.reason = "%s is %g (limit %g)" % (attribute, value, limit)
+                break
+        return self.reason
+
+
+class RepairExecutor(object):
+
+    """Run repair steps as subprocesses, up to a fixed number at once.
+
+    While BackPressure says the node is busy, only one step runs at a time,
+    so the repair still makes progress.  The start, end and exit code of
+    each step are recorded through the CqlWrapper.
+    """
+    POLL_INTERVAL = 1
+
+    def __init__(self, connection, parallel, pressure=None):
+        """
+        :param connection: CqlWrapper, for recording the steps
+        :param parallel: most steps to run at once
+        :param pressure: BackPressure, or None
+        """
+        self.connection = connection
+        self.parallel = max(1, parallel)
+        self.pressure = pressure
+        self.failed = []
+        return
+
+    def limit(self):
+        """How many steps may be running right now."""
+        reason = self.pressure and self.pressure.busy()
+        if reason:
+            logging.info("Node is busy (%s), running one step at a time", reason)
+            return 1
+        return self.parallel
+
+    def run(self, steps):
+        """Run all of the steps.
+        :param steps: list of (step, command)
+        :returns: list of steps which failed
+        """
+        pending = list(steps)
+        pending.reverse()       # So we can pop() them off in order
+        running = {}
+        while pending or running:
+            for process, step in running.items():
+                exit_code = process.poll()
+                if exit_code is None:
+                    continue
+                del running[process]
+                if exit_code:
+                    logging.warning("Step %s exited with %d", step, exit_code)
+                    self.failed.append(step)
+                self.connection.step_finished(step, exit_code)
+            if pending and len(running) < self.limit():
+                step, command = pending.pop()
+                self.connection.step_started(step, command)
+                logging.debug(command)
+                running[subprocess.Popen(command, shell=True)] = step
+                continue
+            time.sleep(self.POLL_INTERVAL)
+        return self.failed
+
+
 class CqlWrapper(object):
 
     """Keep all of the CQL-specific stuff in here so we can have consistent
     retry handling, etc.
 
     Updates to SCHEMA may require updates to create_schema.
+
+    Status and MUTEX records are kept in tables partitioned by data center
+    (ADDED_TABLES), so every query reads a single partition.  The
+    original tables, partitioned by node, are still written (LEGACY_WRITES)
+    so that older copies of this script keep working, and by default
+    (--legacy-tables=read) they are read as well when claiming a repair:
+    older copies only lock through the original MUTEX and status tables, so
+    a node that doesn't read them can claim a repair alongside one of them.
+    Those reads scan the whole table, so they're left until the partitioned
+    tables have said we may go ahead, and --watch doesn't make them.
     """
     SCHEMA = [
         """CREATE KEYSPACE "{keyspace}"
@@ -63,23 +327,91 @@ class CqlWrapper(object):
            WITH comment='Repair status of each node'
         """,
     ]
-    GET_STATUS = """SELECT "repair_status" FROM "repair_status"
-                    WHERE "nodename" = :nodename AND "data_center" = :data_center"""
-    GET_LOCAL_STATUS = """SELECT "nodename", "repair_status" FROM "repair_status"
-                          WHERE "data_center" = :data_center ALLOW FILTERING"""
-    # This next statement could get ugly if you have 1000+ nodes.
-    GET_ALL_STATUS = """SELECT "nodename", "data_center", "repair_status", WRITETIME("repair_status") FROM "repair_status" """
-    MUTEX_START = """INSERT INTO "mutex" ("nodename", "data_center")
-                     VALUES (:nodename, :data_center) USING TTL :ttl"""
-    MUTEX_CHECK = """SELECT "nodename", "data_center" FROM "mutex" """
-    MUTEX_CLEANUP = """DELETE FROM "mutex" WHERE "nodename" = :nodename AND "data_center" = :data_center"""
+    # Tables added since SCHEMA was first used: migrate_schema adds any that
+    # are missing from an existing keyspace.
+    ADDED_TABLES = [
+        ("mutex_by_dc",
+         """CREATE TABLE IF NOT EXISTS "mutex_by_dc" (
+              data_center varchar,
+              nodename varchar,
+              PRIMARY KEY ((data_center), nodename))
+            WITH comment='Poor MUTEX implementation, one partition per data center'
+         """),
+        ("repair_status_by_dc",
+         """CREATE TABLE IF NOT EXISTS "repair_status_by_dc" (
+              data_center varchar,
+              nodename varchar,
+              repair_status varchar,
+              PRIMARY KEY ((data_center), nodename))
+            WITH comment='Repair status of each node, one partition per data center'
+         """),
+        ("repair_steps",
+         """CREATE TABLE IF NOT EXISTS "repair_steps" (
+              data_center varchar,
+              nodename varchar,
+              step varchar,
+              command varchar,
+              started timestamp,
+              finished timestamp,
+              exit_code int,
+              PRIMARY KEY ((data_center, nodename), step))
+            WITH comment='Each step of the current repair of each node'
+         """),
+    ]
+    PROBE_TABLE = """SELECT * FROM "{table}" LIMIT 1"""
+    MUTEX_PAUSE = 5             # Seconds to wait for everyone's MUTEX records to show up
+    GET_STATUS = """SELECT "repair_status" FROM "repair_status_by_dc"
+                    WHERE "data_center" = :data_center AND "nodename" = :nodename"""
+    GET_LOCAL_STATUS = """SELECT "nodename", "repair_status" FROM "repair_status_by_dc"
+                          WHERE "data_center" = :data_center"""
+    GET_DC_STATUS = """SELECT "nodename", "data_center", "repair_status", WRITETIME("repair_status")
+                       FROM "repair_status_by_dc" WHERE "data_center" = :data_center"""
+    MUTEX_START = """INSERT INTO "mutex_by_dc" ("data_center", "nodename")
+                     VALUES (:data_center, :nodename) USING TTL :ttl"""
+    MUTEX_CHECK = """SELECT "nodename", "data_center" FROM "mutex_by_dc" WHERE "data_center" = :data_center"""
+    MUTEX_CLEANUP = """DELETE FROM "mutex_by_dc" WHERE "data_center" = :data_center AND "nodename" = :nodename"""
     SELECT_ALL_DATACENTERS = """SELECT data_center FROM system.peers"""
     SELECT_MY_DATACENTER = """SELECT data_center FROM system.local"""
-    REPAIR_START = """INSERT INTO "repair_status" ("nodename", "data_center", "repair_status")
-                      VALUES (:nodename, :data_center, 'Started') USING TTL :ttl"""
-    REPAIR_UPDATE = """UPDATE "repair_status" USING TTL :ttl SET "repair_status" = :newstatus
-                       WHERE "nodename" = :nodename AND "data_center" = :data_center"""
-    REPAIR_CLEANUP = """DELETE FROM "repair_status" WHERE "nodename" = :nodename AND "data_center" = :data_center"""
+    REPAIR_START = """INSERT INTO "repair_status_by_dc" ("data_center", "nodename", "repair_status")
+                      VALUES (:data_center, :nodename, 'Started') USING TTL :ttl"""
+    REPAIR_UPDATE = """UPDATE "repair_status_by_dc" USING TTL :ttl SET "repair_status" = :newstatus
+                       WHERE "data_center" = :data_center AND "nodename" = :nodename"""
+    REPAIR_CLEANUP = """DELETE FROM "repair_status_by_dc" WHERE "data_center" = :data_center AND "nodename" = :nodename"""
+    REPAIR_COPY = """INSERT INTO "repair_status_by_dc" ("data_center", "nodename", "repair_status")
+                     VALUES (:data_center, :nodename, :repair_status) USING TTL :ttl"""
+    STEP_START = """INSERT INTO "repair_steps" ("data_center", "nodename", "step", "command", "started")
+                    VALUES (:data_center, :nodename, :step, :command, :started) USING TTL :ttl"""
+    STEP_FINISH = """UPDATE "repair_steps" USING TTL :ttl SET "finished" = :finished, "exit_code" = :exit_code
+                     WHERE "data_center" = :data_center AND "nodename" = :nodename AND "step" = :step"""
+    GET_STEPS = """SELECT "step", "command", "exit_code" FROM "repair_steps"
+                   WHERE "data_center" = :data_center AND "nodename" = :nodename"""
+    STEPS_CLEANUP = """DELETE FROM "repair_steps" WHERE "data_center" = :data_center AND "nodename" = :nodename"""
+    SELECT_MY_TOKENS = """SELECT tokens, rack FROM system.local"""
+    SELECT_PEER_TOKENS = """SELECT peer, rpc_address, data_center, tokens, rack FROM system.peers"""
+
+    # The original, node-partitioned tables.
+    LEGACY_GET_STATUS = """SELECT "repair_status" FROM "repair_status"
+                           WHERE "nodename" = :nodename AND "data_center" = :data_center"""
+    LEGACY_GET_LOCAL_STATUS = """SELECT "nodename", "repair_status" FROM "repair_status"
+                                 WHERE "data_center" = :data_center ALLOW FILTERING"""
+    LEGACY_COPY_STATUS = """SELECT "nodename", "data_center", "repair_status", TTL("repair_status") FROM "repair_status" """
+    LEGACY_MUTEX_START = """INSERT INTO "mutex" ("nodename", "data_center")
+                            VALUES (:nodename, :data_center) USING TTL :ttl"""
+    LEGACY_MUTEX_CHECK = """SELECT "nodename", "data_center" FROM "mutex" """
+    LEGACY_MUTEX_CLEANUP = """DELETE FROM "mutex" WHERE "nodename" = :nodename AND "data_center" = :data_center"""
+    LEGACY_REPAIR_START = """INSERT INTO "repair_status" ("nodename", "data_center", "repair_status")
+                             VALUES (:nodename, :data_center, 'Started') USING TTL :ttl"""
+    LEGACY_REPAIR_UPDATE = """UPDATE "repair_status" USING TTL :ttl SET "repair_status" = :newstatus
+                              WHERE "nodename" = :nodename AND "data_center" = :data_center"""
+    LEGACY_REPAIR_CLEANUP = """DELETE FROM "repair_status" WHERE "nodename" = :nodename AND "data_center" = :data_center"""
+    # Writes to the partitioned tables, and their legacy equivalents.
+    LEGACY_WRITES = {
+        MUTEX_START: LEGACY_MUTEX_START,
+        MUTEX_CLEANUP: LEGACY_MUTEX_CLEANUP,
+        REPAIR_START: LEGACY_REPAIR_START,
+        REPAIR_UPDATE: LEGACY_REPAIR_UPDATE,
+        REPAIR_CLEANUP: LEGACY_REPAIR_CLEANUP,
+    }
 
     def __init__(self, option_group):
         """Set up and manage our connection.
@@ -88,10 +420,16 @@ class CqlWrapper(object):
         self.option_group = option_group
         self.nodename = option_group.hostname
         self.conn = None
+        self.legacy_writes = option_group.legacy_tables in ('write', 'read')
+        self.legacy_reads = option_group.legacy_tables == 'read'
+        self.data_centers = None
+        self.resuming = False
+        self.lock_file = None
         try:
             self.standard_connection()
         except:
             self.create_schema()
+        self.migrate_schema()
         self.data_center = self.get_data_center()
         return
 
@@ -106,16 +444,18 @@ class CqlWrapper(object):
             exit(1)
         return result[0][0]
 
+    def connect(self, keyspace):
+        """Connect to Cassandra with whichever driver was chosen.
+        :param keyspace: keyspace to use
+        """
+        logging.debug('connecting to %s with the %s driver', keyspace, self.option_group.driver)
+        self.conn = DRIVERS[self.option_group.driver](self.option_group, keyspace)
+        return
+
     def standard_connection(self):
         """Set up a connection to Cassandra.
         """
-        logging.debug('connecting to %s', self.option_group.keyspace)
-        self.conn = cql.connect(self.option_group.hostname,
-                                self.option_group.port,
-                                self.option_group.keyspace,
-                                user=self.option_group.username,
-                                password=self.option_group.password,
-                                cql_version=self.option_group.cqlversion)
+        self.connect(self.option_group.keyspace)
         return
 
     def create_schema(self):
@@ -124,12 +464,7 @@ class CqlWrapper(object):
         update self.SCHEMA, be sure to update this function, too.
         """
         logging.info('creating schema')
-        self.conn = cql.connect(self.option_group.hostname,
-                                self.option_group.port,
-                                "system",
-                                user=self.option_group.username,
-                                password=self.option_group.password,
-                                cql_version=self.option_group.cqlversion)
+        self.connect("system")
 
         data_center = self.query_or_die(self.SELECT_ALL_DATACENTERS,
                                         "Unable to determine the local data center")
@@ -151,8 +486,38 @@ class CqlWrapper(object):
         # pylint: disable=unused-variable
         keyspace = self.option_group.keyspace
         # pylint: enable=unused-variable
-        for cql_query in self.SCHEMA:
-            self.query(cql_query.format(**locals()))
+        for cql_query in self.SCHEMA + [table[1] for table in self.ADDED_TABLES]:
+            self.conn.execute(cql_query.format(**locals()), prepare=False)
+        return
+
+    def migrate_schema(self):
+        """Add any of ADDED_TABLES missing from a keyspace created before
+        they existed.
+        """
+        for table, cql_query in self.ADDED_TABLES:
+            try:
+                self.conn.execute(self.PROBE_TABLE.format(table=table), consistency_level="ONE")
+                continue
+            except Exception as e:
+                logging.info('adding table %s: %s', table, e)
+            self.conn.execute(cql_query, prepare=False)
+            if table == "repair_status_by_dc":
+                self.copy_legacy_status()
+        return
+
+    def copy_legacy_status(self):
+        """Copy the status records from the original table into the one
+        partitioned by data center.
+        """
+        copied = 0
+        for nodename, data_center, repair_status, ttl in self.query_or_die(
+                self.LEGACY_COPY_STATUS, "Reading repair status to migrate", consistency_level="ONE"):
+            if repair_status is None:
+                continue
+            self.query(self.REPAIR_COPY, nodename=nodename, data_center=data_center,
+                       repair_status=repair_status, ttl=ttl or self.option_group.ttl)
+            copied += 1
+        logging.info('copied %d repair status records', copied)
         return
 
     def query_or_die(self, query_string, error_message, consistency_level="LOCAL_QUORUM", **kwargs):
@@ -173,44 +538,141 @@ class CqlWrapper(object):
         :param kwargs: dictionary to use for parameter substitution in the CQL
         :returns: query results
         """
+        if self.conn and not self.conn.healthy():
+            logging.info("Connection lost, reconnecting")
+            self.close()
         if not self.conn:
             self.standard_connection()
-        cursor = self.conn.cursor()
-        logging.debug("Query: %s, arguments: %s", query_string, str(kwargs))
-        cursor.execute(
-            query_string.encode('ascii'), kwargs, consistency_level=consistency_level)
-        data = cursor.fetchall()
-        cursor.close()
-        logging.debug(str(data))
+        logging.debug("Query: %s, arguments: %s", query_string, kwargs)
+        data = self.conn.execute(query_string, kwargs, consistency_level=consistency_level)
+        logging.debug("Result: %s", data)
+        if self.legacy_writes and query_string in self.LEGACY_WRITES:
+            self.conn.execute(self.LEGACY_WRITES[query_string], kwargs, consistency_level=consistency_level)
         return data
 
+    def get_data_centers(self):
+        """Get the names of all of the data centers (once).
+        :returns: list of data center names
+        """
+        if self.data_centers is None:
+            names = set([row[0] for row in self.query(self.SELECT_ALL_DATACENTERS, consistency_level="ONE")])
+            names.add(self.data_center)
+            self.data_centers = sorted(names)
+        return self.data_centers
+
     def get_all_status(self):
-        """Get the status of all repairs.
+        """Get the status of all repairs, one data center partition at a time.
+        :returns: list of rows, or None if Cassandra couldn't be reached
         """
-        while True:
-            try:
-                return self.query(self.GET_ALL_STATUS, consistency_level="ONE")
-            except:
-                self.close()
-                time.sleep(1)
-        return []
+        try:
+            data = []
+            for data_center in self.get_data_centers():
+                data.extend(self.query(self.GET_DC_STATUS, consistency_level="ONE",
+                                       data_center=data_center))
+            return data
+        except Exception as e:
+            logging.info("Unable to get the repair status: %s", e)
+            self.close()
+        return None
 
     def close(self):
         """Shut down the connection gracefully."""
-        self.conn.close()
+        if self.conn:
+            self.conn.close()
         self.conn = None
         return
 
+    def release(self):
+        """We won't need the connection for a while (e.g. during a repair
+        step), so drop it unless it can look after itself."""
+        if self.conn and not self.conn.keeps_alive:
+            self.close()
+        return
+
+    def state_file(self, suffix):
+        """Name a file in --state-dir for this node and keyspace.
+        :param suffix: what the file is for
+        :returns: path
+        """
+        return os.path.join(self.option_group.state_dir, 'cassandra_repair_scheduler.{0}.{1}.{2}'.format(
+            self.nodename, self.option_group.keyspace, suffix))
+
+    def open_state_file(self, suffix, flags):
+        """Open a file in --state-dir, creating the directory (for our use
+        only) if need be.  The cached repair steps are run as they are, so a
+        file that anyone else could have written is refused.
+        :param suffix: what the file is for
+        :param flags: os.open flags
+        :returns: file descriptor
+        :raises: OSError
+        """
+        if not os.path.isdir(self.option_group.state_dir):
+            os.makedirs(self.option_group.state_dir, 0o700)
+        filename = self.state_file(suffix)
+        fd = os.open(filename, flags | os.O_NOFOLLOW, 0o600)
+        info = os.fstat(fd)
+        if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            os.close(fd)
+            raise OSError(errno.EPERM, "Not ours, or writable by others", filename)
+        return fd
+
+    def lock(self):
+        """Make sure no other copy of this script is repairing from this
+        machine.  The lock is held until we exit.
+        :returns: boolean, True if we got the lock
+        """
+        try:
+            self.lock_file = os.fdopen(self.open_state_file('lock', os.O_WRONLY | os.O_CREAT | os.O_APPEND), 'a')
+        except (IOError, OSError) as e:
+            logging.fatal("Unable to open the lock file: %s", e)
+            exit(1)
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.info("Another copy is already running here")
+            return False
+        return True
+
+    def runs_here(self):
+        """Check that --hostname is this machine: only then does holding
+        the lock mean that no other run is still going.
+        :returns: boolean
+        """
+        names = set([platform.node(), socket.gethostname(), socket.getfqdn()])
+        if self.nodename in names or self.nodename in [name.split('.')[0] for name in names]:
+            return True
+        try:
+            address = socket.gethostbyname(self.nodename)
+            return address.startswith('127.') or address in socket.gethostbyname_ex(socket.gethostname())[2]
+        except socket.error:
+            return False
+
     def check_should_run(self):
         """Check to see if it is appropriate to start up.
         :returns: boolean
         """
+        if not self.lock():
+            return False
         logging.debug("Check to see if we're already running a repair")
         result = self.query_or_die(
             self.GET_STATUS, "Checking status",
             nodename=self.nodename, data_center=self.data_center)
+        if not result and self.legacy_reads:
+            result = self.query_or_die(
+                self.LEGACY_GET_STATUS, "Checking status",
+                nodename=self.nodename, data_center=self.data_center)
         # If there's any result at all, either a run is in progress, or the
-        # last completed run hasn't expired yet.  Either way, bail.
+        # last completed run hasn't expired yet.  Either way, bail.  Unless
+        # we're resuming: since we hold the lock, a run in progress must
+        # have died (as long as it ran here, with the same lock).
+        if result and self.option_group.resume and result[0][0] != COMPLETED:
+            if not self.runs_here():
+                logging.info("Not resuming: %s isn't this machine, so its repair may still be running",
+                             self.nodename)
+                return False
+            logging.info("Resuming the interrupted repair, last at %s", result[0][0])
+            self.resuming = True
+            return True
         if result:
             logging.info("Repair in progress: %s", result[0][0])
             return False
@@ -220,10 +682,18 @@ class CqlWrapper(object):
                                    "Checking local ring status",
                                    nodename=self.nodename,
                                    data_center=self.data_center)
-
-        if result:
-            already_running = [x[0] for x in result if x[1] != COMPLETED]
-            if already_running:
+        already_running = [x[0] for x in result if x[1] != COMPLETED]
+        if already_running and not self.admitted(already_running, [self.nodename]):
+            logging.info("Another node is repairing.: %s", already_running[0])
+            return False
+        if self.legacy_reads:
+            # Repairs by older copies of this script only show up here.
+            result = self.query_or_die(self.LEGACY_GET_LOCAL_STATUS,
+                                       "Checking local ring status",
+                                       data_center=self.data_center)
+            already_running.extend([x[0] for x in result
+                                    if x[1] != COMPLETED and x[0] not in already_running])
+            if already_running and not self.admitted(already_running, [self.nodename]):
                 logging.info("Another node is repairing.: %s", already_running[0])
                 return False
         self.query_or_die(self.MUTEX_START, "Starting MUTEX",
@@ -231,16 +701,108 @@ class CqlWrapper(object):
                           data_center=self.data_center,
                           ttl=self.option_group.ttl)
         # Totally arbitrary delay here, because I don't trust C*.
-        logging.debug('Five second pause here')
-        time.sleep(5)
+        logging.debug('%s second pause here', self.MUTEX_PAUSE)
+        time.sleep(self.MUTEX_PAUSE)
         result = self.query_or_die(self.MUTEX_CHECK, "Checking MUTEX",
                                    consistency_level="ONE",
                                    data_center=self.data_center)
-        if not result or not [x[0] for x in result if x[1] == self.data_center][0] == self.nodename:
+        if self.legacy_reads:
+            # Any older copy of this script contending for our data center
+            # only shows up here, so let it win.
+            contenders = self.query_or_die(self.LEGACY_MUTEX_CHECK, "Checking MUTEX",
+                                           consistency_level="ONE")
+            if [x for x in contenders if x[1] == self.data_center and x[0] not in [y[0] for y in result]]:
+                result = []
+        contenders = [x[0] for x in result if x[1] == self.data_center]
+        if not contenders or self.nodename not in self.admitted(already_running, contenders):
             self.query(self.MUTEX_CLEANUP, nodename=self.nodename, data_center=self.data_center)
             return False
         return True
 
+    def admitted(self, running, contenders):
+        """Work out which of the contenders may start repairing, given the
+        nodes already running repairs in our data center.  No more than
+        --nodes-per-dc may repair at once, and (when there's more than one)
+        only nodes far enough apart in the ring that they share no replicas.
+        Every node makes the same choice: the contenders are taken in order.
+        :param running: names of nodes already repairing
+        :param contenders: names of nodes wanting to start
+        :returns: list of contenders that may start
+        """
+        limit = self.option_group.nodes_per_dc
+        chosen = list(running)
+        admitted = []
+        ring = limit > 1 and self.get_ring() or None
+        for nodename in sorted(contenders):
+            if len(chosen) >= limit:
+                break
+            if chosen and (not ring or [x for x in chosen if self.overlaps(ring, x, nodename)]):
+                continue
+            chosen.append(nodename)
+            admitted.append(nodename)
+        return admitted
+
+    def get_ring(self):
+        """Find each node's position in our data center's ring.
+        :returns: (dict of name or address: position, ring size), or None
+          if that can't be worked out (e.g. with vnodes, or with more than
+          one rack, where NetworkTopologyStrategy places replicas by rack
+          rather than on the next nodes along the ring)
+        """
+        try:
+            nodes = []
+            racks = set()
+            for tokens, rack in self.query(self.SELECT_MY_TOKENS, consistency_level="ONE"):
+                if len(tokens) != 1:
+                    raise ValueError("%d tokens" % len(tokens))
+                nodes.append((int(list(tokens)[0]), [self.nodename]))
+                racks.add(rack)
+            for peer, rpc_address, data_center, tokens, rack in self.query(self.SELECT_PEER_TOKENS,
+                                                                           consistency_level="ONE"):
+                if data_center != self.data_center:
+                    continue
+                if len(tokens) != 1:
+                    raise ValueError("%s has %d tokens" % (peer, len(tokens)))
+                nodes.append((int(list(tokens)[0]), [str(peer), str(rpc_address)]))
+                racks.add(rack)
+            if len(racks) > 1:
+                raise ValueError("%d racks in %s" % (len(racks), self.data_center))
+        except Exception as e:
+            logging.info("Unable to place nodes in the ring, so only one may repair: %s", e)
+            return None
+        nodes.sort()
+        positions = {}
+        for position, (_, names) in enumerate(nodes):
+            for name in names:
+                positions[name] = position
+        return positions, len(nodes)
+
+    def overlaps(self, ring, left, right):
+        """Check whether two nodes' repairs could involve the same replicas.
+        Each node's ranges are replicated on up to --replication-factor
+        nodes either side of it, so they're clear if they're at least twice
+        that far apart.  That only holds with a single rack (see get_ring).
+        :param ring: result of get_ring
+        :param left: node name
+        :param right: node name
+        :returns: boolean (True if we can't tell)
+        """
+        positions, size = ring
+        places = []
+        for nodename in (left, right):
+            place = positions.get(nodename)
+            if place is None:
+                try:
+                    place = positions.get(socket.gethostbyname(nodename))
+                except socket.error:
+                    pass
+            if place is None:
+                return True
+            places.append(place)
+        distance = abs(places[0] - places[1])
+        distance = min(distance, size - distance)
+        return distance < 2 * self.option_group.replication_factor - 1
+
     def claim_repair(self):
         """Insert a row claiming that we're starting the repair,
         then remove the MUTEX."""
@@ -251,32 +813,72 @@ class CqlWrapper(object):
                           "Dropping MUTEX record",
                           nodename=self.nodename,
                           data_center=self.data_center)
-        self.close()
+        if not self.resuming:
+            # Forget the steps of any earlier run.
+            self.query_or_die(self.STEPS_CLEANUP, "Clearing old repair steps",
+                              nodename=self.nodename, data_center=self.data_center)
+        self.release()
         return
 
-    def run_repair(self):
-        """Run the entire repair"""
+    def get_topology(self):
+        """Describe the ring, for noticing when it changes.
+        :returns: sorted list of (data_center, node, sorted tokens)
+        """
+        topology = []
+        for tokens, _ in self.query(self.SELECT_MY_TOKENS, consistency_level="ONE"):
+            topology.append((self.data_center, self.nodename, sorted(tokens or [])))
+        for peer, _, data_center, tokens, _ in self.query(self.SELECT_PEER_TOKENS, consistency_level="ONE"):
+            topology.append((data_center, str(peer), sorted(tokens or [])))
+        return sorted(topology)
+
+    def get_plan(self):
+        """Get the repair steps from range_repair --dry-run, which is slow, so
+        the result is kept in --state-dir until the ring changes.
+        :returns: list of (step, command)
+        """
         cmd = [self.option_group.range_repair_tool,
                "-D", self.data_center,
                "-H", self.nodename,
                "--dry-run"]     # So we get a list of commands to run.
         if self.option_group.local:
             cmd.append("--local")
+        key = hashlib.sha1(json.dumps([cmd, self.get_topology()])).hexdigest()
+        filename = self.state_file('plan')
+        try:
+            with os.fdopen(self.open_state_file('plan', os.O_RDONLY)) as plan_file:
+                plan = json.load(plan_file)
+            if plan['key'] == key:
+                logging.debug("using the repair steps in %s", filename)
+                return plan['steps']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.debug("no usable repair steps in %s: %s", filename, e)
         logging.debug("geting repair steps, this may take a while")
-        repair_steps = subprocess.check_output(cmd).split('\n')
-        for line in repair_steps:
-            if not line:
-                continue
-            step, repair_command = line.split(" ", 1)
-            try:
-                self.query(self.REPAIR_UPDATE, nodename=self.nodename,
-                           newstatus=step, data_center=self.data_center,
-                           ttl=self.option_group.ttl)
-            except:
-                logging.warning("Failed to update repair status, continuing anyway")
-            self.close()        # Individual repairs may be slow
-            logging.debug(repair_command)
-            subprocess.call(repair_command, shell=True)
+        steps = [line.split(" ", 1) for line in subprocess.check_output(cmd).split('\n') if line]
+        try:
+            with os.fdopen(self.open_state_file('plan.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC), 'w') as plan_file:
+                json.dump({'key': key, 'steps': steps}, plan_file)
+            os.rename(filename + '.new', filename)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to save the repair steps in %s: %s", filename, e)
+        return steps
+
+    def run_repair(self):
+        """Run the entire repair"""
+        repair_steps = self.get_plan()
+        if self.resuming:
+            done = set([row[1] for row in self.query_or_die(
+                self.GET_STEPS, "Getting completed repair steps",
+                nodename=self.nodename, data_center=self.data_center) if row[2] == 0])
+            logging.info("Skipping %d of %d repair steps, already done",
+                         len([step for step in repair_steps if step[1] in done]), len(repair_steps))
+            repair_steps = [step for step in repair_steps if step[1] not in done]
+        pressure = None
+        if self.option_group.max_pending_compactions or self.option_group.max_load:
+            pressure = BackPressure(self.nodename, self.option_group.mx4j_port,
+                                    self.option_group.max_pending_compactions, self.option_group.max_load)
+        failed = RepairExecutor(self, self.option_group.parallel, pressure).run(repair_steps)
+        if failed:
+            logging.warning("%d of %d repair steps failed", len(failed), len(repair_steps))
         try:
             self.query(self.REPAIR_UPDATE, nodename=self.nodename,
                        ttl=self.option_group.ttl, data_center=self.data_center,
@@ -285,11 +887,43 @@ class CqlWrapper(object):
             logging.warning("Failed to update repair status, continuing anyway")
         return
 
+    def step_started(self, step, command):
+        """Record the start of a repair step.
+        :param step: step name
+        :param command: what's being run
+        """
+        try:
+            self.query(self.REPAIR_UPDATE, nodename=self.nodename,
+                       newstatus=step, data_center=self.data_center,
+                       ttl=self.option_group.ttl)
+            self.query(self.STEP_START, nodename=self.nodename, data_center=self.data_center,
+                       step=step, command=command, started=int(time.time() * 1000),
+                       ttl=self.option_group.ttl)
+        except:
+            logging.warning("Failed to update repair status, continuing anyway")
+        self.release()          # Individual repairs may be slow
+        return
+
+    def step_finished(self, step, exit_code):
+        """Record the end of a repair step.
+        :param step: step name
+        :param exit_code: the step's exit code
+        """
+        try:
+            self.query(self.STEP_FINISH, nodename=self.nodename, data_center=self.data_center,
+                       step=step, finished=int(time.time() * 1000), exit_code=exit_code,
+                       ttl=self.option_group.ttl)
+        except:
+            logging.warning("Failed to record the end of step %s, continuing anyway", step)
+        self.release()
+        return
+
     def reset_repair_status(self):
         """Reset the repair status by removing the records from the database.
         """
         self.query(self.MUTEX_CLEANUP, nodename=self.nodename, data_center=self.data_center)
         self.query(self.REPAIR_CLEANUP, nodename=self.nodename, data_center=self.data_center)
+        self.query(self.STEPS_CLEANUP, nodename=self.nodename, data_center=self.data_center)
         return
 
 def status_update_loop(connection, options, status_dict):
@@ -301,13 +935,15 @@ def status_update_loop(connection, options, status_dict):
     """
     while True:
         start_time = time.time()
-        new_names = []
-        for row in connection.get_all_status():
+        new_names = set()
+        data = connection.get_all_status()
+        # On failure, keep showing what we had and try again next time.
+        for row in data or []:
             status_dict[row[0]] = row
-            new_names.append(row[0])
-        logging.debug("status_update_loop: status: %s", str(status_dict))
+            new_names.add(row[0])
+        logging.debug("status_update_loop: status: %s", status_dict)
         for nodename in status_dict.keys():
-            if not nodename in new_names: del status_dict[nodename]
+            if data is not None and not nodename in new_names: del status_dict[nodename]
         end_time = time.time()
         delta_time = options[DELAY] - (end_time - start_time)
         if delta_time > 0: time.sleep(delta_time)
@@ -375,7 +1011,7 @@ def screen_update_loop(window, options, status_dict):
                                                  status="Status",
                                                  delay="Time since last update"), curses.A_BOLD)
         display_data.extend(complete_data)
-        logging.debug("all data: %s", str(display_data))
+        logging.debug("all data: %s", display_data)
         current_row = 4
         for line in display_data:
             if current_row > RESTY-1:
@@ -471,8 +1107,10 @@ def cli_parsing():
                         help="Send log messages to a file")
     parser.add_argument("-H", "--hostname", default=platform.node(),
                         help="Hostname (default: %(default)s)")
-    parser.add_argument("-p", "--port", default=9160, type=int,
-                        help="Port (default: %(default)d)")
+    parser.add_argument("--driver", choices=sorted(DRIVERS), default='thrift',
+                        help="Use the native protocol (cassandra-driver) or Thrift (cql) (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int,
+                        help="Port (default: 9042 for native, 9160 for thrift)")
     parser.add_argument("-U", "--username",
                         help="Username (if necessary)")
     parser.add_argument("-P", "--password",
@@ -482,17 +1120,48 @@ def cli_parsing():
     parser.add_argument("-k", "--keyspace", default="operations",
                         help="Keyspace to use (default: %(default)s)")
     parser.add_argument("--cqlversion", default="3.0.5",
-                        help="CQL version (default: %(default)s)")
+                        help="CQL version, for thrift (default: %(default)s)")
     parser.add_argument("-r", "--range_repair_tool",
                         default="/usr/local/bin/range_repair.py",
                         help="Range repair tool path (default: %(default)s)")
     parser.add_argument("--local", default=False, action="store_true",
                         help="Run the repairs in the local ring only")
+    parser.add_argument("--parallel", default=1, type=int, metavar="N",
+                        help="Repair steps to run at once (default: %(default)d)")
+    parser.add_argument("--nodes-per-dc", default=1, type=int, metavar="K",
+                        help="Nodes in a data center that may repair at once, if their "
+                        "replicas don't overlap (default: %(default)d)")
+    parser.add_argument("--replication-factor", default=3, type=int,
+                        help="Largest replication factor in any data center, "
+                        "for --nodes-per-dc (default: %(default)d)")
+    parser.add_argument("--max-pending-compactions", default=0, type=int,
+                        help="Run one step at a time while there are more pending compactions "
+                        "than this, 0 for no limit (default: %(default)d)")
+    parser.add_argument("--max-load", default=0.0, type=float,
+                        help="Run one step at a time while the load average is higher than "
+                        "this, 0 for no limit (default: %(default)g)")
+    parser.add_argument("--mx4j-port", default=8081, type=int,
+                        help="MX4J port, for --max-pending-compactions and --max-load (default: %(default)d)")
     parser.add_argument("--watch", action="store_true", default=False,
                         help="Watch the live repair status")
     parser.add_argument("--reset", action="store_true", default=False,
                         help="Reset the repair status for the host")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Carry on with an interrupted repair, skipping the steps already done "
+                        "(only when run on the node itself)")
+    parser.add_argument("--state-dir", default="/var/lib/cassandra_repair_scheduler",
+                        help="Where to keep the lock and the cached repair steps, which must be "
+                        "writable by nobody else (default: %(default)s)")
+    parser.add_argument("--legacy-tables", choices=['none', 'write', 'read'], default='read',
+                        help="Keep the original (node-partitioned) tables up to date, and read them "
+                        "when claiming a repair. "
+                        "Only use 'write' or 'none' once no older versions of this script are running "
+                        "(default: %(default)s)")
     options = parser.parse_args()
+    if not DRIVERS[options.driver].available:
+        parser.error('The %s driver is not installed' % options.driver)
+    if not options.port:
+        options.port = DRIVERS[options.driver].DEFAULT_PORT
     setup_logging(options)
     if options.username and not options.password:
         options.password = getpass.getpass(